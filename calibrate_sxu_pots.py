@@ -9,17 +9,23 @@ import datetime
 import json
 import os
 import sys
+import threading
 import time
 
 import epics
-import matplotlib
-import matplotlib.pyplot as plt
 import numpy as np
 
 try:
-    matplotlib.use('Agg')
-except Exception:
-    pass
+    import concurrent.futures
+except ImportError:
+    # Python 2 without the `futures` backport: connect to PVs one at a time
+    concurrent = None
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    # Python 2 has no monotonic clock; fall back to the wall clock
+    monotonic = time.time
 
 
 _print = print
@@ -27,8 +33,11 @@ _print = print
 
 def print(*args, **kwargs):
     file = kwargs.pop('file', sys.stdout)
+    # Flush by default; flush=False is for output flushed by the caller
+    flush = kwargs.pop('flush', True)
     _print(*args, file=file, **kwargs)
-    file.flush()
+    if flush:
+        file.flush()
 
 
 class TimeoutError(Exception):
@@ -38,7 +47,8 @@ class TimeoutError(Exception):
 PHYSICS_DATA = os.environ.get('PHYSICS_DATA')
 GAP0 = 10
 GAP1 = 22
-BLOCK_THICKNESSES = [
+# Block thicknesses [mm], in the order they are measured
+BLOCK_THICKNESSES = np.array([
     7.4, 7,
     6.5, 6,
     5.5, 5,
@@ -47,33 +57,80 @@ BLOCK_THICKNESSES = [
     2.5, 2,
     1.5, 1,
     0.0,
-    ]
+    ], dtype=np.float64)
+BLOCK_THICKNESSES.setflags(write=False)
 
 
 class PV(epics.PV):
-    def __init__(self, pvname, auto_monitor=None, **kw):
-        super(PV, self).__init__(pvname, auto_monitor=False, **kw)
-
-    def get(self, use_monitor=False, **kw):
+    def __init__(self, pvname, auto_monitor=None, monitor=False, **kw):
+        # Monitoring is opt-in, for frequently-read readbacks
+        super(PV, self).__init__(pvname, auto_monitor=monitor, **kw)
+
+    def get(self, use_monitor=None, **kw):
+        if use_monitor is None:
+            # Monitored PVs return the last value pushed by the IOC
+            use_monitor = bool(self.auto_monitor)
         value = super(PV, self).get(use_monitor=use_monitor, **kw)
         # Key difference to pyepics: raise when a timeout occurs
         if value is None:
             raise TimeoutError('Timed out while reading value')
         return value
 
-    def get_averaged(self, count=10, delay=0.2, verbose=True, **kw):
-        readings = []
+    def iter_readings(self, count=10, delay=0.2):
+        'Yield `count` readings, `delay` seconds apart'
+        # Pace against a fixed schedule, at least delay / 2 apart
+        start = monotonic()
         for i in range(count):
-            readings.append(self.get())
-            print('.', end='')
-            time.sleep(delay)
+            yield self.get(use_monitor=False)
+            next_reading = start + (i + 1) * delay
+            time.sleep(max(delay / 2.0, next_reading - monotonic()))
 
-        return readings, np.average(readings)
+    def get_averaged(self, count=10, delay=0.2, verbose=True, **kw):
+        readings = np.empty(count, dtype=np.float64)
+        for i, value in enumerate(self.iter_readings(count, delay)):
+            readings[i] = value
+            print('.', end='', flush=False)
+
+        sys.stdout.flush()
+        return readings, readings.mean()
 
 
 epics.pv.PV = PV
 
 
+_pvs = {}
+
+
+def get_pv(pvname, monitor=False):
+    'Get a shared PV instance, so pots on the same gap use the same channel'
+    key = (pvname, monitor)
+    if key not in _pvs:
+        _pvs[key] = PV(pvname, monitor=monitor)
+    return _pvs[key]
+
+
+def wait_for_connection(pvs, timeout=5.0):
+    'Wait for all of `pvs` to connect, searching for them in parallel'
+    def wait(pv):
+        # Worker threads need to attach to the shared CA context
+        epics.ca.use_initial_context()
+        return pv.wait_for_connection(timeout=timeout)
+
+    if concurrent is None:
+        return [pv.wait_for_connection(timeout=timeout) for pv in pvs]
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(pvs)) as executor:
+        return list(executor.map(wait, pvs))
+
+
+def put_wait(pv, value, timeout=5.0):
+    'Put and wait for completion, warning if it does not complete in time'
+    if pv.put(value, wait=True, timeout=timeout) == -1:
+        print('Warning: put of {} to {} did not complete within {} s'
+              ''.format(value, pv.pvname, timeout))
+
+
 class PotBase(object):
     # Awful OO for my convenience
 
@@ -83,16 +140,16 @@ class PotBase(object):
         self.prefix = self.gap_prefix + suffix
         self.suffix = suffix
 
-        self.gap_des_pv = PV(self.gap_prefix + 'GapDes')
-        self.gap_act_pv = PV(self.gap_prefix + 'GapAct')
-        self.gap_go_pv = PV(self.gap_prefix + 'Go')
+        self.gap_des_pv = get_pv(self.gap_prefix + 'GapDes')
+        self.gap_act_pv = get_pv(self.gap_prefix + 'GapAct', monitor=True)
+        self.gap_go_pv = get_pv(self.gap_prefix + 'Go')
 
-        self.voltage_pv = PV(self.prefix + 'VAct')
-        self.voltage_ref_pv = PV(self.prefix + 'PotVRef')
-        self.gap_ref_pv = PV(self.prefix + 'GapRef')
-        self.slope_pv = PV(self.prefix + 'PotSlope')
-        self.offset_pv = PV(self.prefix + 'PotOffset')
-        self.center_line_shift_pv = PV(self.prefix + 'CtrLnShift')
+        self.voltage_pv = get_pv(self.prefix + 'VAct')
+        self.voltage_ref_pv = get_pv(self.prefix + 'PotVRef')
+        self.gap_ref_pv = get_pv(self.prefix + 'GapRef')
+        self.slope_pv = get_pv(self.prefix + 'PotSlope')
+        self.offset_pv = get_pv(self.prefix + 'PotOffset')
+        self.center_line_shift_pv = get_pv(self.prefix + 'CtrLnShift')
 
         self.all_pvs = [
             self.gap_des_pv, self.gap_act_pv, self.gap_go_pv,
@@ -100,8 +157,7 @@ class PotBase(object):
             self.slope_pv, self.offset_pv, self.center_line_shift_pv
         ]
 
-        for pv in self.all_pvs:
-            pv.wait_for_connection()
+        wait_for_connection(self.all_pvs)
 
     @property
     def short_name(self):
@@ -111,12 +167,21 @@ class PotBase(object):
     def connected(self):
         return all(pv.connected for pv in self.all_pvs)
 
-    def get_filename(self, extension):
+    def get_filename(self, extension, timestamp=None):
         fn = get_filename(self.cell, suffix=self.suffix.strip(':'),
-                          extension=extension)
+                          extension=extension, timestamp=timestamp)
         print('Writing to {}'.format(fn))
         return fn
 
+    @property
+    def resume_filename(self):
+        'Checkpoint of block measurements, for resuming an interrupted run'
+        return os.path.join(
+            PHYSICS_DATA, 'undMotion', 'sxu_pots',
+            '_resume_cell_{}_{}.json'.format(self.cell,
+                                             self.suffix.strip(':'))
+        )
+
     def __repr__(self):
         return ('<{class_name} prefix={prefix!r} connected={connected}>'
                 ''.format(class_name=type(self).__name__,
@@ -158,43 +223,78 @@ def query(message, allow_no=False):
 def move_gap(pots, gap, tolerance=0.001):
     query('OK to move the gap to {}?'.format(gap))
     print('Moving to {}...'.format(gap))
-    pots.gap_des_pv.put(gap)
-    time.sleep(0.1)
+    put_wait(pots.gap_des_pv, gap)
+    # Completion of Go would follow the whole move; the GapAct wait below
+    # detects when it is done
     pots.gap_go_pv.put(1)
-    time.sleep(0.1)
 
-    def print_gap(msg='Gap at'):
-        print('{} {} (err={})'.format(msg,
-                                      pots.gap_act_pv.get(),
-                                      pots.gap_act_pv.get() - gap))
-
-    while abs(pots.gap_act_pv.get() - gap) > tolerance:
-        time.sleep(0.5)
-        print_gap()
-
-    print_gap('Gap at target')
+    def print_gap(gap_act, msg='Gap at'):
+        print('{} {} (err={})'.format(msg, gap_act, gap_act - gap))
+
+    at_target = threading.Event()
+
+    def gap_updated(value=None, **kw):
+        if value is not None and abs(value - gap) <= tolerance:
+            at_target.set()
+
+    # Only the value is needed; skip fetching the control fields (units,
+    # limits, ...) that add_callback requests by default
+    index = pots.gap_act_pv.add_callback(gap_updated, run_now=True,
+                                         with_ctrlvars=False)
+    try:
+        # The monitor is only the fast path: it may never post a value
+        # within tolerance, so also poll a fresh reading
+        while not at_target.wait(timeout=0.5):
+            gap_act = pots.gap_act_pv.get(use_monitor=False)
+            print_gap(gap_act)
+            if abs(gap_act - gap) <= tolerance:
+                break
+    finally:
+        pots.gap_act_pv.remove_callback(index)
+
+    print_gap(pots.gap_act_pv.get(use_monitor=False), 'Gap at target')
     print()
 
 
 def read_potentiometer(pots, count=10, delay=0.2, max_fluctuation=0.007):
+    readings = np.empty(count, dtype=np.float64)
     while True:
-        data, avg = pots.voltage_pv.get_averaged(count=count, delay=delay)
-        min_max = np.max(data) - np.min(data)
-        if min_max <= max_fluctuation:
-            return avg
+        # Peak-to-peak only grows as readings come in, so give up on a
+        # fluctuating potentiometer as soon as it exceeds the maximum
+        for i, value in enumerate(pots.voltage_pv.iter_readings(count, delay)):
+            readings[i] = value
+            print('.', end='', flush=False)
+            if np.ptp(readings[:i + 1]) > max_fluctuation:
+                break
+        else:
+            sys.stdout.flush()
+            return readings.mean()
+
+        sys.stdout.flush()
+
         query('Potentiometer exceeded maximum voltage fluctuation of {}. '
               'Retry?'.format(max_fluctuation))
 
 
-def get_calibration_data(pots):
+def get_calibration_data(pots, timestamp=None):
     ''
     if not pots.connected:
         raise TimeoutError('Not all PVs connected')
 
-    data = {'blocks': {},
+    # Block measurements are kept as parallel arrays in measurement order
+    data = {'blocks_thickness': BLOCK_THICKNESSES,
+            'blocks_voltage': np.full(len(BLOCK_THICKNESSES), np.nan),
             'gaps': {},
             }
 
+    resumed = _load_checkpoint(pots.resume_filename)
+    if resumed is not None:
+        num_measured = np.count_nonzero(~np.isnan(resumed['blocks_voltage']))
+        if query('Resume with {} block(s) already measured in {}?'
+                 ''.format(num_measured, pots.resume_filename),
+                 allow_no=True):
+            data['blocks_voltage'] = resumed['blocks_voltage']
+
     for gap in (GAP0, GAP1):
         move_gap(pots, gap)
         time.sleep(0.5)
@@ -209,7 +309,12 @@ def get_calibration_data(pots):
             query('OK to caput reference voltage?')
             pots.voltage_ref_pv.put(voltage)
 
+    # Skip over blocks measured before the run was interrupted
     i = 0
+    while (i < len(BLOCK_THICKNESSES) and
+           not np.isnan(data['blocks_voltage'][i])):
+        i += 1
+
     while i < len(BLOCK_THICKNESSES):
         block = BLOCK_THICKNESSES[i]
         ret = query(
@@ -223,12 +328,14 @@ def get_calibration_data(pots):
                 i -= 1
             continue
 
-        data['blocks'][block] = read_potentiometer(pots)
+        data['blocks_voltage'][i] = read_potentiometer(pots)
         print()
         print('>Recording point< {:.1f} mm block potentiometer voltage {:.4f}'
-              ''.format(block, data['blocks'][block])
+              ''.format(block, data['blocks_voltage'][i])
               )
 
+        _save_checkpoint(pots.resume_filename, data)
+
         i += 1
 
     move_gap(pots, 10)
@@ -245,38 +352,97 @@ def get_calibration_data(pots):
     print()
     print('>Recording point< slope: ', data['slope'])
     print('>Recording point< offset:', data['offset'])
-    plot(pots, data)
+    plot(pots, data, timestamp=timestamp)
     return data
 
 
+def _linfit(x, y):
+    'Closed-form least-squares line fit of y = m * x + c, returning (m, c)'
+    x_mean = x.mean()
+    y_mean = y.mean()
+    dx = x - x_mean
+    m = (dx * (y - y_mean)).sum() / (dx * dx).sum()
+    return m, y_mean - m * x_mean
+
+
 def calculate_slope_offset(data, gap0=GAP0, gap1=GAP1):
     equiv_block = abs(gap1 - gap0) / 2
-    equiv_voltage = data['blocks'][equiv_block]
-    blocks = list(sorted(data['blocks']))
-    voltages = [data['blocks'][block]
-                for block in blocks]
-    delta_extension = [equiv_block - block
-                       for block in blocks]
-    delta_voltage = [equiv_voltage - voltage
-                     for voltage in voltages]
-
-    slope, _ = np.polyfit(voltages, delta_extension, 1)
-    _, offset = np.polyfit(delta_voltage, delta_extension, 1)
+    blocks = data['blocks_thickness']
+    voltages = data['blocks_voltage']
+    equiv_voltage = voltages[blocks == equiv_block][0]
+    delta_extension = equiv_block - blocks
+    delta_voltage = equiv_voltage - voltages
+
+    slope, _ = _linfit(voltages, delta_extension)
+    # delta_voltage is an affine function of voltages with a slope of -1,
+    # so its fit has slope -slope and passes through the means
+    offset = delta_extension.mean() + slope * delta_voltage.mean()
     return slope, offset
 
 
-def plot(pots, data):
+def _as_dict(data):
+    'Calibration data with the block arrays as a {thickness: voltage} dict'
+    as_dict = {key: value for key, value in data.items()
+               if key not in ('blocks_thickness', 'blocks_voltage')}
+    as_dict['blocks'] = {
+        float(block): float(voltage)
+        for block, voltage in zip(data['blocks_thickness'],
+                                  data['blocks_voltage'])
+        if not np.isnan(voltage)
+    }
+    return as_dict
+
+
+def _from_dict(as_dict):
+    'Inverse of _as_dict(), with unmeasured blocks set to NaN'
+    data = {key: value for key, value in as_dict.items() if key != 'blocks'}
+    blocks = {float(block): voltage
+              for block, voltage in as_dict['blocks'].items()}
+    data['blocks_thickness'] = BLOCK_THICKNESSES
+    data['blocks_voltage'] = np.array(
+        [blocks.get(block, np.nan) for block in BLOCK_THICKNESSES],
+        dtype=np.float64)
+    return data
+
+
+def _save_checkpoint(filename, data):
+    'Replace the checkpoint atomically, so it is never left truncated'
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wt') as f:
+        json.dump(_as_dict(data), f)
+    os.rename(temp_filename, filename)
+
+
+def _load_checkpoint(filename):
+    'Calibration data from a checkpoint, or None if missing or unreadable'
+    if not os.path.exists(filename):
+        return None
+
+    try:
+        with open(filename, 'rt') as f:
+            return _from_dict(json.load(f))
+    except (ValueError, KeyError) as ex:
+        print('Warning: ignoring unreadable checkpoint {}: {}'
+              ''.format(filename, ex))
+        return None
+
+
+def plot(pots, data, timestamp=None):
     '''According to appropriate linear potentiometer, fit cam rotary pot'''
+    # Deferred, as pyplot is slow to import and only needed for saving plots
+    import matplotlib
+    try:
+        matplotlib.use('Agg')
+    except Exception:
+        pass
+    import matplotlib.pyplot as plt
+
     fig, ax = plt.subplots(1, 1, figsize=(9, 6))
     plt.title('SXU {} Potentiometer Calibration'.format(pots.short_name))
     plt.xlabel('Block [mm]')
     plt.ylabel('Linear potentiometer [V]')
 
-    blocks = list(sorted(data['blocks']))
-    voltages = [data['blocks'][block]
-                for block in blocks]
-
-    ax.plot(blocks, voltages, 'o-')
+    ax.plot(data['blocks_thickness'], data['blocks_voltage'], 'o-')
 
     text_info = '''
 Slope     : {:.4f}
@@ -296,12 +462,17 @@ Offset    : {:.4f}
                  fontsize=12,
                  )
 
-    plt.savefig(pots.get_filename('png'))
+    plt.savefig(pots.get_filename('png', timestamp=timestamp))
     return fig, ax
 
 
-def get_filename(cell, suffix='', extension='txt'):
-    timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+def get_timestamp():
+    return datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+
+
+def get_filename(cell, suffix='', extension='txt', timestamp=None):
+    if timestamp is None:
+        timestamp = get_timestamp()
     return os.path.join(
         PHYSICS_DATA, 'undMotion', 'sxu_pots',
         'cell_{}_{}{}.{}'.format(
@@ -315,6 +486,8 @@ def get_filename(cell, suffix='', extension='txt'):
 def calibrate(cell):
     ds = DownstreamPot(cell)
     us = UpstreamPot(cell)
+    # Share one timestamp between all files written during this run
+    timestamp = get_timestamp()
 
     def print_connected(pv):
         print('{}\t{}' ''.format(pv.pvname, 'connected'
@@ -337,7 +510,7 @@ def calibrate(cell):
         print(file=sys.stderr)
 
         print('Running calibration on {}...'.format(part.short_name))
-        data[part] = get_calibration_data(part)
+        data[part] = get_calibration_data(part, timestamp=timestamp)
 
         to_write = [
             (part.voltage_ref_pv, data[part]['gaps'][GAP0]),
@@ -357,8 +530,12 @@ def calibrate(cell):
             for pv, value in to_write:
                 pv.put(value)
 
-        with open(part.get_filename('json'), 'wt') as f:
-            json.dump(data[part], f)
+        with open(part.get_filename('json', timestamp=timestamp),
+                  'wt') as f:
+            json.dump(_as_dict(data[part]), f)
+
+        # Only discard the checkpoint once the results are safely on disk
+        os.remove(part.resume_filename)
 
     return data
 
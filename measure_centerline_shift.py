@@ -9,17 +9,23 @@ import datetime
 import json
 import os
 import sys
+import threading
 import time
 
 import epics
-import matplotlib
-import matplotlib.pyplot as plt
 import numpy as np
 
 try:
-    matplotlib.use('Agg')
-except Exception:
-    pass
+    import concurrent.futures
+except ImportError:
+    # Python 2 without the `futures` backport: connect to PVs one at a time
+    concurrent = None
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    # Python 2 has no monotonic clock; fall back to the wall clock
+    monotonic = time.time
 
 
 _print = print
@@ -27,8 +33,11 @@ _print = print
 
 def print(*args, **kwargs):
     file = kwargs.pop('file', sys.stdout)
+    # Flush by default; flush=False is for output flushed by the caller
+    flush = kwargs.pop('flush', True)
     _print(*args, file=file, **kwargs)
-    file.flush()
+    if flush:
+        file.flush()
 
 
 class TimeoutError(Exception):
@@ -73,28 +82,95 @@ MOVES = [
 
 
 class PV(epics.PV):
-    def __init__(self, pvname, auto_monitor=None, **kw):
-        super(PV, self).__init__(pvname, auto_monitor=False, **kw)
-
-    def get(self, use_monitor=False, **kw):
+    def __init__(self, pvname, auto_monitor=None, monitor=False, **kw):
+        # Monitoring is opt-in, for frequently-read readbacks
+        super(PV, self).__init__(pvname, auto_monitor=monitor, **kw)
+
+    def get(self, use_monitor=None, **kw):
+        if use_monitor is None:
+            # Monitored PVs return the last value pushed by the IOC
+            use_monitor = bool(self.auto_monitor)
         value = super(PV, self).get(use_monitor=use_monitor, **kw)
         # Key difference to pyepics: raise when a timeout occurs
         if value is None:
             raise TimeoutError('Timed out while reading value')
         return value
 
-    def get_averaged(self, count=10, delay=0.2, verbose=True, **kw):
-        readings = []
+    def iter_readings(self, count=10, delay=0.2):
+        'Yield `count` readings, `delay` seconds apart'
+        # Pace against a fixed schedule, at least delay / 2 apart
+        start = monotonic()
         for i in range(count):
-            readings.append(self.get())
-            time.sleep(delay)
+            yield self.get(use_monitor=False)
+            next_reading = start + (i + 1) * delay
+            time.sleep(max(delay / 2.0, next_reading - monotonic()))
 
-        return readings, np.average(readings)
+    def get_averaged(self, count=10, delay=0.2, verbose=True, **kw):
+        readings = np.empty(count, dtype=np.float64)
+        for i, value in enumerate(self.iter_readings(count, delay)):
+            readings[i] = value
+
+        return readings, readings.mean()
 
 
 epics.pv.PV = PV
 
 
+def wait_for_connection(pvs, timeout=5.0):
+    'Wait for all of `pvs` to connect, searching for them in parallel'
+    def wait(pv):
+        # Worker threads need to attach to the shared CA context
+        epics.ca.use_initial_context()
+        return pv.wait_for_connection(timeout=timeout)
+
+    if concurrent is None:
+        return [pv.wait_for_connection(timeout=timeout) for pv in pvs]
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(pvs)) as executor:
+        return list(executor.map(wait, pvs))
+
+
+def put_many(values, timeout=5.0):
+    'Put to all (pv, value) pairs in parallel, waiting for every completion'
+    if not values:
+        return
+
+    pending = set(pv.pvname for pv, _ in values)
+    lock = threading.Lock()
+    all_done = threading.Event()
+
+    def put_complete(pvname=None, **kw):
+        with lock:
+            pending.discard(pvname)
+            if not pending:
+                all_done.set()
+
+    for pv, value in values:
+        pv.put(value, callback=put_complete)
+
+    if not all_done.wait(timeout=timeout):
+        with lock:
+            incomplete = ', '.join(sorted(pending))
+        print('Warning: puts to {} did not complete within {} s'
+              ''.format(incomplete, timeout))
+
+
+def get_averaged_many(pvs, count=10, delay=0.2):
+    'Average readings of all of `pvs` concurrently, one result per PV'
+    def get_averaged(pv):
+        # Worker threads need to attach to the shared CA context
+        epics.ca.use_initial_context()
+        return pv.get_averaged(count=count, delay=delay)
+
+    if concurrent is None:
+        return [pv.get_averaged(count=count, delay=delay) for pv in pvs]
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(pvs)) as executor:
+        return list(executor.map(get_averaged, pvs))
+
+
 class Interspace(object):
     def __init__(self, cell):
         self.cell = cell
@@ -102,13 +178,13 @@ class Interspace(object):
 
         self.x_desired_pv = PV(self.prefix + 'QXDES')
         self.y_desired_pv = PV(self.prefix + 'QYDES')
-        self.y_readback_pv = PV(self.prefix + 'YRDBCKCALC')
+        self.y_readback_pv = PV(self.prefix + 'YRDBCKCALC', monitor=True)
         self.roll_desired_pv = PV(self.prefix + 'QROLLDES')
         self.pitch_desired_pv = PV(self.prefix + 'QPITCHDES')
         self.yaw_desired_pv = PV(self.prefix + 'QYAWDES')
 
         self.go_pv = PV(self.prefix + 'TRIGGERCAL.PROC')
-        self.moving_pv = PV(self.prefix + 'CAMSMOVING')
+        self.moving_pv = PV(self.prefix + 'CAMSMOVING', monitor=True)
 
         self.all_pvs = [
             self.x_desired_pv, self.y_desired_pv, self.y_readback_pv,
@@ -116,8 +192,7 @@ class Interspace(object):
             self.go_pv, self.moving_pv,
         ]
 
-        for pv in self.all_pvs:
-            pv.wait_for_connection()
+        wait_for_connection(self.all_pvs)
 
     @property
     def short_name(self):
@@ -134,15 +209,29 @@ class Interspace(object):
                           connected=self.connected)
                 )
 
-    def wait_move(self):
-        delta = 1.0
-        while abs(delta) > 0.005:
-            y_rdbk = self.y_readback_pv.get()
-            y_des = self.y_desired_pv.get()
-            delta = y_des - y_rdbk
+    def wait_move(self, tolerance=0.005):
+        y_des = self.y_desired_pv.get()
+        in_position = threading.Event()
+
+        def y_updated(value=None, **kw):
+            if value is not None and abs(y_des - value) <= tolerance:
+                in_position.set()
+
+        # Only the value is needed; skip fetching the control fields
+        index = self.y_readback_pv.add_callback(y_updated, run_now=True,
+                                                with_ctrlvars=False)
+        try:
+            # As in move_gap, poll a fresh reading in case no monitor update
+            # lands within tolerance; the timeout also keeps Ctrl-C working
+            while not in_position.wait(timeout=0.1):
+                y_rdbk = self.y_readback_pv.get(use_monitor=False)
+                if abs(y_des - y_rdbk) <= tolerance:
+                    break
+        finally:
+            self.y_readback_pv.remove_callback(index)
 
         while int(self.moving_pv.get()) != 1:
-            time.sleep(0.5)
+            time.sleep(0.1)
 
 
 class Undulator(object):
@@ -158,8 +247,7 @@ class Undulator(object):
             self.ds_shift_pv,
         ]
 
-        for pv in self.all_pvs:
-            pv.wait_for_connection()
+        wait_for_connection(self.all_pvs)
 
     @property
     def short_name(self):
@@ -169,8 +257,8 @@ class Undulator(object):
     def connected(self):
         return all(pv.connected for pv in self.all_pvs)
 
-    def get_filename(self, extension):
-        fn = get_filename(self.cell, extension=extension)
+    def get_filename(self, extension, timestamp=None):
+        fn = get_filename(self.cell, extension=extension, timestamp=timestamp)
         print('Writing to {}'.format(fn))
         return fn
 
@@ -203,17 +291,28 @@ def query(message, allow_no=False):
 
 
 def read_potentiometer(pots, count=10, delay=0.2, max_fluctuation=0.007):
+    readings = np.empty(count, dtype=np.float64)
     while True:
-        data, avg = pots.voltage_pv.get_averaged(count=count, delay=delay)
-        min_max = np.max(data) - np.min(data)
-        if min_max <= max_fluctuation:
-            return avg
+        # Peak-to-peak only grows as readings come in, so give up on a
+        # fluctuating potentiometer as soon as it exceeds the maximum
+        for i, value in enumerate(pots.voltage_pv.iter_readings(count, delay)):
+            readings[i] = value
+            if np.ptp(readings[:i + 1]) > max_fluctuation:
+                break
+        else:
+            return readings.mean()
+
         query('Potentiometer exceeded maximum voltage fluctuation of {}. '
               'Retry?'.format(max_fluctuation))
 
 
-def get_filename(cell, suffix='', extension='txt'):
-    timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+def get_timestamp():
+    return datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+
+
+def get_filename(cell, suffix='', extension='txt', timestamp=None):
+    if timestamp is None:
+        timestamp = get_timestamp()
     return os.path.join(
         PHYSICS_DATA, 'undMotion', 'sxu_centerline',
         'cell_{}_{}{}.{}'.format(
@@ -226,6 +325,8 @@ def get_filename(cell, suffix='', extension='txt'):
 
 def calibrate(cell, us_offset, ds_offset, max_us_y, max_ds_y):
     undulator = Undulator(cell)
+    # Name the output after the start of the run, not the end
+    timestamp = get_timestamp()
     us_interspace = Interspace(cell - 1)
     ds_interspace = Interspace(cell)
 
@@ -265,28 +366,26 @@ def calibrate(cell, us_offset, ds_offset, max_us_y, max_ds_y):
         line = '{}\t{}\t{}\t'.format(undulator.short_name, us_pos, ds_pos)
         print(line, end='', file=sys.stderr)
         for interspace, pos in [(us_interspace, us_pos), (ds_interspace, ds_pos)]:
-            interspace.x_desired_pv.put(0.0)
-            time.sleep(0.1)
-            interspace.y_desired_pv.put(pos)
-            time.sleep(0.1)
-            interspace.roll_desired_pv.put(0.0)
-            time.sleep(0.1)
-            interspace.pitch_desired_pv.put(0.0)
-            time.sleep(0.1)
-            interspace.yaw_desired_pv.put(0.0)
-            time.sleep(0.1)
+            put_many([
+                (interspace.x_desired_pv, 0.0),
+                (interspace.y_desired_pv, pos),
+                (interspace.roll_desired_pv, 0.0),
+                (interspace.pitch_desired_pv, 0.0),
+                (interspace.yaw_desired_pv, 0.0),
+            ])
+            # wait_move() detects the end of the move, not put completion
             us_interspace.go_pv.put(1)
-            time.sleep(0.1)
             us_interspace.wait_move()
 
-        _, us_shift = undulator.us_shift_pv.get_averaged()
-        _, ds_shift = undulator.ds_shift_pv.get_averaged()
+        (_, us_shift), (_, ds_shift) = get_averaged_many(
+            [undulator.us_shift_pv, undulator.ds_shift_pv])
 
         shifts = '{:.4f}\t{:.4f}'.format(us_shift, ds_shift)
         print(shifts, file=sys.stderr)
         data.append(line + shifts)
 
-    with open(undulator.get_filename('txt'), 'wt') as f:
+    with open(undulator.get_filename('txt', timestamp=timestamp),
+              'wt') as f:
         print('\n'.join(data), file=f)
 
     return data